@@ -4,9 +4,9 @@ from os.path import dirname, realpath
 from .config import Config
 
 ROOT_PATH = dirname(dirname(dirname(realpath(__file__))))
-SAVE_PATH = os.path.join(ROOT_PATH, 'save')
-DATA_PATH = os.path.join(ROOT_PATH, 'data')
-DATASET_PATH = os.path.join(DATA_PATH, 'dataset')
-MODEL_PATH = os.path.join(DATA_PATH, 'model')
-PRETRAIN_PATH = os.path.join(MODEL_PATH, 'pretrain')
-EMBEDDING_PATH = os.path.join(DATA_PATH, 'embedding')
+SAVE_PATH = f"{ROOT_PATH}{os.sep}save"
+DATA_PATH = f"{ROOT_PATH}{os.sep}data"
+DATASET_PATH = f"{DATA_PATH}{os.sep}dataset"
+MODEL_PATH = f"{DATA_PATH}{os.sep}model"
+PRETRAIN_PATH = f"{MODEL_PATH}{os.sep}pretrain"
+EMBEDDING_PATH = f"{DATA_PATH}{os.sep}embedding"
@@ -36,6 +36,8 @@ class Config:
         # pretrain epoch
         self.opt['pretrain'] = pretrain
         self.opt['pretrain_epoch'] = pretrain_epoch
+        # distributed runs shuffle with their own generator, seeded alike on every rank
+        self.opt['shuffle_seed'] = seed
         # gpu
         os.environ['CUDA_VISIBLE_DEVICES'] = gpu
         self.opt['gpu'] = [i for i in range(len(gpu.split(',')))]
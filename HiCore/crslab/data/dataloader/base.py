@@ -2,6 +2,8 @@
 import random
 from abc import ABC
 
+import torch
+import torch.distributed as dist
 from loguru import logger
 from math import ceil
 from tqdm import tqdm
@@ -26,6 +28,8 @@ class BaseDataLoader(ABC):
         self.dataset = dataset
         self.scale = opt.get('scale', 1)
         assert 0 < self.scale <= 1
+        self.shuffle_seed = opt.get('shuffle_seed', 0)
+        self._shuffle_epoch = 0
 
     def get_data(self, batch_fn, batch_size, shuffle=True, process_fn=None):
         """Collate batch data for system to fit
@@ -47,20 +51,50 @@ class BaseDataLoader(ABC):
         dataset = dataset[:ceil(len(dataset) * self.scale)]
         logger.debug(f'[Dataset size: {len(dataset)}]')
 
-        batch_num = ceil(len(dataset) / batch_size)
         idx_list = list(range(len(dataset)))
-        if shuffle:
+        distributed = shuffle and dist.is_available() and dist.is_initialized()
+        if distributed:
+            idx_list = self._shard(idx_list)
+        elif shuffle:
             random.shuffle(idx_list)
+        batch_num = ceil(len(idx_list) / batch_size)
 
         for start_idx in tqdm(range(batch_num)):
             batch_idx = idx_list[start_idx * batch_size: (start_idx + 1) * batch_size]
             batch = [dataset[idx] for idx in batch_idx]
             batch = batch_fn(batch)
+            if distributed:
+                # a rank that skips alone would leave the others waiting in the gradient all-reduce
+                batch_ok = torch.tensor(float(batch is not False), device=self._collective_device())
+                dist.all_reduce(batch_ok, op=dist.ReduceOp.MIN)
+                if not batch_ok.item():
+                    continue
             if batch == False:
                 continue
             else:
                 yield(batch) 
 
+    def _shard(self, idx_list):
+        """Shuffle and shard the epoch like DistributedSampler(drop_last=False).
+
+        The shuffle uses a generator seeded with shuffle_seed and the epoch, which is the same on every rank
+        whatever else draws from the global random module. The list is padded with its own head to a multiple
+        of the world size, so every rank gets as many samples, and batches.
+
+        """
+        rng = random.Random(self.shuffle_seed + self._shuffle_epoch)
+        self._shuffle_epoch += 1
+        rng.shuffle(idx_list)
+        world_size = dist.get_world_size()
+        padding = -len(idx_list) % world_size
+        idx_list += (idx_list * ceil(padding / max(len(idx_list), 1)))[:padding]
+        return idx_list[dist.get_rank()::world_size]
+
+    @staticmethod
+    def _collective_device():
+        # NCCL only reduces CUDA tensors
+        return torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+
     def get_conv_data(self, batch_size, shuffle=True):
         """get_data wrapper for conversation.
 
@@ -10,7 +10,7 @@ from tqdm import tqdm
 
 from crslab.config import DATASET_PATH
 from crslab.data.dataset.base import BaseDataset
-from .resources import resources
+from .resources import get_resource
 
 
 class HTGReDialDataset(BaseDataset):
@@ -48,7 +48,7 @@ class HTGReDialDataset(BaseDataset):
             save (bool): whether to save dataset after processing. Defaults to False.
 
         """
-        resource = resources[tokenize]
+        resource = get_resource(tokenize)
         dpath = os.path.join(DATASET_PATH, "htgredial")
         super().__init__(opt, dpath, resource, restore, save)
 
@@ -1,11 +1,13 @@
 
 
+import functools
+
 from crslab.download import DownloadableFile
 
-resources = {
+_RESOURCE_SPECS = {
     'pkuseg': {
         'version': '0.31',
-        'file': DownloadableFile(
+        'file': (
             'https://pkueducn-my.sharepoint.com/:u:/g/personal/franciszhou_pku_edu_cn/EdVnNcteOkpAkLdNL-ejvAABPieUd8jIty3r1jcdJvGLzw?download=1',
             'redial_nltk.zip',
             '01dc2ebf15a0988a92112daa7015ada3e95d855e80cc1474037a86e536de3424',
@@ -21,7 +23,7 @@ resources = {
     },
     'bert': {
         'version': '0.31',
-        'file': DownloadableFile(
+        'file': (
             'https://pkueducn-my.sharepoint.com/:u:/g/personal/franciszhou_pku_edu_cn/EXe_sjFhfqpJoTbNcoUPJf8Bl_4U-lnduct0z8Dw5HVCPw?download=1',
             'redial_bert.zip',
             'fb55516c22acfd3ba073e05101415568ed3398c86ff56792f82426b9258c92fd',
@@ -39,7 +41,7 @@ resources = {
     },
     'gpt2': {
         'version': '0.31',
-        'file': DownloadableFile(
+        'file': (
             'https://pkueducn-my.sharepoint.com/:u:/g/personal/franciszhou_pku_edu_cn/EQHOlW2m6mFEqHgt94PfoLsBbmQQeKQEOMyL1lLEHz7LvA?download=1',
             'redial_gpt2.zip',
             '37b1a64032241903a37b5e014ee36e50d09f7e4a849058688e9af52027a3ac36',
@@ -56,3 +58,14 @@ resources = {
         },
     }
 }
+
+
+@functools.lru_cache(None)
+def get_resource(name):
+    """Build the resource of the given tokenizer, creating its DownloadableFile on first use."""
+    spec = _RESOURCE_SPECS[name]
+    return {
+        'version': spec['version'],
+        'file': DownloadableFile(*spec['file']),
+        'special_token_idx': spec['special_token_idx'],
+    }
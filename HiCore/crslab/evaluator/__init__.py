@@ -1,5 +1,7 @@
 
 
+import functools
+
 from loguru import logger
 
 from .standard import StandardEvaluator
@@ -10,11 +12,16 @@ Evaluator_register_table = {
 }
 
 
-def get_evaluator(evaluator_name, dataset, file_path):
+@functools.lru_cache(maxsize=8)
+def get_evaluator(evaluator_name, dataset, file_path, approx_dist=False):
     if evaluator_name in Evaluator_register_table:
         language = dataset_language_map[dataset]
-        evaluator = Evaluator_register_table[evaluator_name](language, file_path)
+        evaluator = Evaluator_register_table[evaluator_name](language, file_path, approx_dist)
         logger.info(f'[Build evaluator {evaluator_name}]')
         return evaluator
     else:
         raise NotImplementedError(f'Model [{evaluator_name}] has not been implemented')
+
+
+def clear_caches():
+    get_evaluator.cache_clear()
@@ -8,6 +8,10 @@ class BaseEvaluator(ABC):
     def rec_evaluate(self, preds, label):
         pass
 
+    def rec_evaluate_batch(self, preds, labels):
+        for pred, label in zip(preds, labels):
+            self.rec_evaluate(pred, label)
+
     def gen_evaluate(self, preds, label):
         pass
 
@@ -163,6 +163,13 @@ class AverageMetric(Metric):
         # always keep the same return type
         return type(self)(numer=full_numer, denom=full_denom)
 
+    def add(self, numer: TScalar, denom: TScalar = 1) -> None:
+        """
+        Accumulate a value in place, without building a new metric.
+        """
+        self._numer += numer
+        self._denom += denom
+
     def value(self) -> float:
         if self._numer == 0 and self._denom == 0:
             # don't nan out if we haven't counted anything
@@ -172,6 +179,63 @@ class AverageMetric(Metric):
         return self._numer / self._denom
 
 
+class SetUnionMetric(Metric):
+    """
+    Class that keeps the union of all ids seen so far.
+
+    Examples of SetUnionMetric include coverage, the number of distinct items that have
+    been recommended since the last report.
+    """
+
+    __slots__ = ('_set',)
+
+    def __init__(self, ids=()):
+        self._set = set(ids)
+
+    def __add__(self, other: Optional['SetUnionMetric']) -> 'SetUnionMetric':
+        if other is None:
+            return self
+        return type(self)(self._set | other._set)
+
+    def __iadd__(self, other: Optional['SetUnionMetric']) -> 'SetUnionMetric':
+        # grow the union in place instead of copying it for every example
+        if other is not None:
+            self._set |= other._set
+        return self
+
+    def value(self) -> int:
+        return len(self._set)
+
+
+class SetListMetric(Metric):
+    """
+    Class that keeps one frozenset of ids per example.
+
+    Examples of SetListMetric include isolation, which compares the recommendation lists
+    of every pair of examples at report time.
+    """
+
+    __slots__ = ('_sets',)
+
+    def __init__(self, ids_list=()):
+        self._sets = [frozenset(ids) for ids in ids_list]
+
+    def __add__(self, other: Optional['SetListMetric']) -> 'SetListMetric':
+        if other is None:
+            return self
+        metric = type(self)()
+        metric._sets = self._sets + other._sets
+        return metric
+
+    def __iadd__(self, other: Optional['SetListMetric']) -> 'SetListMetric':
+        if other is not None:
+            self._sets.extend(other._sets)
+        return self
+
+    def value(self) -> List[frozenset]:
+        return self._sets
+
+
 def aggregate_unnamed_reports(reports: List[Dict[str, Metric]]) -> Dict[str, Metric]:
     """
     Combines metrics without regard for tracking provenence.
@@ -190,6 +254,7 @@ class Metrics(object):
 
     def __init__(self):
         self._data = {}
+        self._report = None
 
     def __str__(self):
         return str(self._data)
@@ -210,20 +275,43 @@ class Metrics(object):
         """
         Record an accumulation to a metric.
         """
-        self._data[key] = self._data.get(key) + value
+        metric = self._data.get(key)
+        metric += value
+        self._data[key] = metric
+        self._report = None
+
+    def add_many(self, updates: Dict[str, Optional[Metric]]) -> None:
+        """
+        Record accumulations to several metrics at once.
+        """
+        data = self._data
+        for key, value in updates.items():
+            metric = data.get(key)
+            metric += value
+            data[key] = metric
+        self._report = None
+
+    def invalidate(self):
+        """
+        Drop the cached report after metrics were updated in place.
+        """
+        self._report = None
 
     def report(self):
         """
         Report the metrics over all data seen so far.
+
+        The report is cached until the metrics change, so repeated calls return the same dict.
         """
+        if self._report is not None:
+            return self._report
         res = {}
         for k, v in self._data.items():
-            if "cov" in k:
-                v = SumMetric(len(set(v.value())))
             if "iso" in k:
                 temp = cal_isolation_index(v.value())
                 v = SumMetric(temp)
             res[k] = v
+        self._report = res
         return res
 
     def clear(self):
@@ -231,6 +319,7 @@ class Metrics(object):
         Clear all the metrics.
         """
         self._data.clear()
+        self._report = None
 
 def jaccard_similarity(set1:set, set2:set):
     intersection = len(set1.intersection(set2))
@@ -238,16 +327,17 @@ def jaccard_similarity(set1:set, set2:set):
     return intersection / union
 
 def cal_isolation_index(ranks):
+    ranks = [frozenset(rank) for rank in ranks]
     num_users = len(ranks)
     total_similarity = 0
 
     for i in range(num_users):
-        user_i_ranks = set(ranks[i])
+        user_i_ranks = ranks[i]
         user_similarity_sum = 0
 
         for j in range(num_users):
             if i != j:
-                user_j_ranks = set(ranks[j])
+                user_j_ranks = ranks[j]
                 similarity = jaccard_similarity(user_i_ranks, user_j_ranks)
                 user_similarity_sum += similarity
 
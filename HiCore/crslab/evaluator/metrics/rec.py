@@ -1,40 +1,64 @@
 
 import math
 
-from crslab.evaluator.metrics.base import AverageMetric, SumMetric
+from crslab.evaluator.metrics.base import AverageMetric, SetListMetric, SetUnionMetric
+
+MAX_K = 100
+_INV_LOG2 = [1 / math.log2(i + 2) for i in range(MAX_K)]
+
+
+def _find_rank(ranks, label, k):
+    """Return the position of label in ranks[:k], or -1 if it is not there."""
+    try:
+        label_rank = ranks.index(label)
+    except ValueError:
+        return -1
+    return label_rank if label_rank < k else -1
+
+
+def hit_ndcg_mrr(ranks, label, ks):
+    """Compute (hit, ndcg, mrr) for every cutoff in ks with a single search for label."""
+    label_rank = _find_rank(ranks, label, len(ranks))
+    if label_rank < 0:
+        return [(0, 0, 0)] * len(ks)
+    ndcg = _INV_LOG2[label_rank] if label_rank < MAX_K else 1 / math.log2(label_rank + 2)
+    mrr = 1 / (label_rank + 1)
+    return [(1, ndcg, mrr) if label_rank < k else (0, 0, 0) for k in ks]
 
 
 class HitMetric(AverageMetric):
     @staticmethod
     def compute(ranks, label, k) -> 'HitMetric':
-        return HitMetric(int(label in ranks[:k]))
+        return HitMetric(int(_find_rank(ranks, label, k) >= 0))
 
 
 class NDCGMetric(AverageMetric):
     @staticmethod
     def compute(ranks, label, k) -> 'NDCGMetric':
-        if label in ranks[:k]:
-            label_rank = ranks.index(label)
-            return NDCGMetric(1 / math.log2(label_rank + 2))
-        return NDCGMetric(0)
+        label_rank = _find_rank(ranks, label, k)
+        if label_rank < 0:
+            return NDCGMetric(0)
+        if label_rank < MAX_K:
+            return NDCGMetric(_INV_LOG2[label_rank])
+        return NDCGMetric(1 / math.log2(label_rank + 2))
 
 
 class MRRMetric(AverageMetric):
     @staticmethod
     def compute(ranks, label, k) -> 'MRRMetric':
-        if label in ranks[:k]:
-            label_rank = ranks.index(label)
-            return MRRMetric(1 / (label_rank + 1))
-        return MRRMetric(0)
+        label_rank = _find_rank(ranks, label, k)
+        if label_rank < 0:
+            return MRRMetric(0)
+        return MRRMetric(1 / (label_rank + 1))
 
 
-class CovMetric(SumMetric):
+class CovMetric(SetUnionMetric):
     @staticmethod
     def compute(ranks, label, k) -> 'CovMetric':
         return CovMetric(ranks[:k])
-    
 
-class IsoMetric(SumMetric):
+
+class IsoMetric(SetListMetric):
     @staticmethod
     def compute(ranks, label, k) -> 'IsoMetric':
-        return IsoMetric([ranks[:k]])
\ No newline at end of file
+        return IsoMetric([ranks[:k]])
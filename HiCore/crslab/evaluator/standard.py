@@ -1,11 +1,32 @@
 
 from collections import defaultdict
+from functools import partial
+
+import numpy as np
+import torch
 from loguru import logger
-from nltk import ngrams
 
 from crslab.evaluator.base import BaseEvaluator
 from crslab.evaluator.utils import nice_report
 from .metrics import *
+from .metrics.rec import hit_ndcg_mrr
+
+try:
+    from datasketch import HyperLogLogPlusPlus
+except ImportError:
+    HyperLogLogPlusPlus = None
+
+_HNM_KEYS = {k: (f"hit@{k}", f"ndcg@{k}", f"mrr@{k}") for k in (1, 10, 50)}
+_CI_KEYS = {k: (f"cov@{k}", f"iso@{k}") for k in (5, 10, 15, 20)}
+_DIST_KEYS = ("dist@1", "dist@2", "dist@3", "dist@4")
+_GRAM_SHIFT = np.uint64(16)
+_GRAM_ID_LIMIT = 1 << 16
+
+
+def _is_main_process():
+    # under torchrun every rank evaluates its shard, only rank 0 writes the rankfile and logs reports
+    return not (torch.distributed.is_available() and torch.distributed.is_initialized()) or \
+        torch.distributed.get_rank() == 0
 
 
 class StandardEvaluator(BaseEvaluator):
@@ -15,62 +36,167 @@ class StandardEvaluator(BaseEvaluator):
         rec_metrics: the metrics to evaluate recommender model, including hit@K, ndcg@K and mrr@K
         dist_set: the set to record dist n-gram
         dist_cnt: the count of dist n-gram evaluation
+        approx_dist: whether to estimate the number of distinct n-grams with HyperLogLog sketches
         gen_metrics: the metrics to evaluate conversational model, including bleu, dist, embedding metrics, f1
         optim_metrics: the metrics to optimize in training
     """
 
-    def __init__(self, language, file_path=None):
+    def __init__(self, language, file_path=None, approx_dist=False):
         super(StandardEvaluator, self).__init__()
         self.file_path = file_path
-        self.rankfile = []
+        self._rankfile_handle = None
         # rec
         self.rec_metrics = Metrics()
+        self._rec_slots = None
         # gen
-        self.dist_set = defaultdict(set)
+        if approx_dist and HyperLogLogPlusPlus is None:
+            logger.warning('[datasketch is not installed, dist@k will be computed exactly]')
+            approx_dist = False
+        self.approx_dist = approx_dist
+        self.dist_set = defaultdict(partial(HyperLogLogPlusPlus, p=14) if approx_dist else set)
         self.dist_cnt = 0
+        # exact n-gram keys are packed ints until an id does not fit in 16 bits, then tuples
+        self._pack_grams = True
         self.gen_metrics = Metrics()
         # optim
         self.optim_metrics = Metrics()
+        self._last_report = None
+
+    def _write_ranks(self, ranks):
+        if self.file_path is None or not _is_main_process():
+            return
+        if self._rankfile_handle is None:
+            self._rankfile_handle = open(self.file_path, "w", buffering=1 << 20, encoding="utf-8")
+        if isinstance(ranks, np.ndarray):
+            # one formatting pass and one write for the whole batch
+            np.savetxt(self._rankfile_handle, ranks.reshape(1, -1), fmt='%d', newline=' ')
+        else:
+            self._rankfile_handle.write(" ".join(map(str, ranks)) + " ")
+
+    def _init_metric_slots(self, rank_len):
+        """Register the rec metrics once and keep direct references to them for the hot path."""
+        hnm_slots = []
+        for k, keys in _HNM_KEYS.items():
+            if rank_len >= k:
+                slots = (HitMetric(0, 0), NDCGMetric(0, 0), MRRMetric(0, 0))
+                for key, slot in zip(keys, slots):
+                    self.rec_metrics.add(key, slot)
+                hnm_slots.append((k, slots))
+        ci_slots = []
+        for k, keys in _CI_KEYS.items():
+            if rank_len >= k:
+                slots = (CovMetric(), IsoMetric())
+                for key, slot in zip(keys, slots):
+                    self.rec_metrics.add(key, slot)
+                ci_slots.append((k, slots))
+        self._rec_slots = ([k for k, _ in hnm_slots], [slots for _, slots in hnm_slots], ci_slots)
 
     def rec_evaluate(self, ranks, label):
-        self.rankfile += ranks[:50]
-        for k in [1, 10, 50]:
-            if len(ranks) >= k:
-                self.rec_metrics.add(f"hit@{k}", HitMetric.compute(ranks, label, k))
-                self.rec_metrics.add(f"ndcg@{k}", NDCGMetric.compute(ranks, label, k))
-                self.rec_metrics.add(f"mrr@{k}", MRRMetric.compute(ranks, label, k))
-        for k in [5, 10, 15, 20]:
-            if len(ranks) >= k:
-                self.rec_metrics.add(f"cov@{k}", CovMetric.compute(ranks, label, k))
-                self.rec_metrics.add(f"iso@{k}", IsoMetric.compute(ranks, label, k))
+        self._write_ranks(ranks[:50])
+        if self._rec_slots is None:
+            self._init_metric_slots(len(ranks))
+        ks, hnm_slots, ci_slots = self._rec_slots
+        self.rec_metrics.invalidate()
+        for (hit_metric, ndcg_metric, mrr_metric), (hit, ndcg, mrr) in zip(hnm_slots, hit_ndcg_mrr(ranks, label, ks)):
+            hit_metric.add(hit)
+            ndcg_metric.add(ndcg)
+            mrr_metric.add(mrr)
+        top20 = ranks[:20]
+        for k, (cov_metric, iso_metric) in ci_slots:
+            top_k = top20[:k]
+            cov_metric += CovMetric(top_k)
+            iso_metric += IsoMetric([top_k])
+
+    def rec_evaluate_batch(self, ranks, labels):
+        """Evaluate the rankings of a whole batch at once.
+
+        Args:
+            ranks (np.ndarray): (batch_size, rank_len) ranked item ids.
+            labels (np.ndarray): (batch_size,) target item ids.
+        """
+        ranks = np.asarray(ranks)
+        labels = np.asarray(labels)
+        batch_size, rank_len = ranks.shape
+        self._write_ranks(ranks[:, :50])
+        if self._rec_slots is None:
+            self._init_metric_slots(rank_len)
+        ks, hnm_slots, ci_slots = self._rec_slots
+        self.rec_metrics.invalidate()
+        matched = ranks == labels[:, None]
+        found = matched.any(axis=1)
+        label_rank = matched.argmax(axis=1)
+        inv_log2 = 1 / np.log2(np.arange(2, rank_len + 2))
+        for k, (hit_metric, ndcg_metric, mrr_metric) in zip(ks, hnm_slots):
+            hit = found & (label_rank < k)
+            hit_metric.add(int(hit.sum()), batch_size)
+            ndcg_metric.add(float((hit * inv_log2[label_rank]).sum()), batch_size)
+            mrr_metric.add(float((hit / (label_rank + 1)).sum()), batch_size)
+        for k, (cov_metric, iso_metric) in ci_slots:
+            cov_metric += CovMetric(ranks[:, :k].ravel().tolist())
+            iso_metric += IsoMetric(ranks[:, :k].tolist())
 
     def gen_evaluate(self, hyp, refs, seq=None):
         if hyp:
-            self.gen_metrics.add("f1", F1Metric.compute(hyp, refs))
+            updates = {"f1": F1Metric.compute(hyp, refs)}
 
+            tokens = list(seq)
+            if self.approx_dist:
+                # fixed-width bytes encode an n-gram the same way whatever the vocabulary size
+                ids = np.asarray(tokens, dtype=np.uint32)
+            elif self._pack_grams and tokens and max(tokens) >= _GRAM_ID_LIMIT:
+                self._unpack_dist_set()
+            # up to four 16-bit token ids pack exactly into one uint64
+            packed = np.asarray(tokens, dtype=np.uint64) if self._pack_grams else None
+            grams = packed
             for k in range(1, 5):
-                self.gen_metrics.add(f"bleu@{k}", BleuMetric.compute(hyp, refs, k))
-                for token in ngrams(seq, k):
-                    self.dist_set[f"dist@{k}"].add(token)
+                updates[f"bleu@{k}"] = BleuMetric.compute(hyp, refs, k)
+                # only the number of distinct n-grams is reported, so one encoding is kept per evaluator
+                if self.approx_dist:
+                    sketch = self.dist_set[_DIST_KEYS[k - 1]]
+                    for i in range(len(ids) - k + 1):
+                        sketch.update(ids[i:i + k].tobytes())
+                elif self._pack_grams:
+                    if k > 1:
+                        grams = (grams[:-1] << _GRAM_SHIFT) | packed[k - 1:]
+                    self.dist_set[_DIST_KEYS[k - 1]].update(grams.tolist())
+                else:
+                    self.dist_set[_DIST_KEYS[k - 1]].update(tuple(tokens[i:i + k]) for i in range(len(tokens) - k + 1))
+            self.gen_metrics.add_many(updates)
             self.dist_cnt += 1
 
+    def _unpack_dist_set(self):
+        """Switch the exact n-gram sets from packed ints to tuples, for a token id that does not fit in 16 bits."""
+        mask = _GRAM_ID_LIMIT - 1
+        for k, dist_key in enumerate(_DIST_KEYS, 1):
+            if dist_key in self.dist_set:
+                self.dist_set[dist_key] = {tuple((gram >> (16 * (k - 1 - j))) & mask for j in range(k))
+                                           for gram in self.dist_set[dist_key]}
+        self._pack_grams = False
+
     def report(self, epoch=-1, mode='test'):
-        if self.file_path is not None and len(self.rankfile) > 0:
-            with open(self.file_path, "w", encoding="utf-8") as file:
-                for rank in self.rankfile:
-                    file.write(f"{rank} ")
-        self.rankfile = []
-        for k, v in self.dist_set.items():
-            self.gen_metrics.add(k, AverageMetric(len(v) / self.dist_cnt))
+        if self._rankfile_handle is not None:
+            self._rankfile_handle.close()
+            self._rankfile_handle = None
+        if self.dist_set:
+            self.gen_metrics.add_many({
+                k: AverageMetric((v.count() if self.approx_dist else len(v)) / self.dist_cnt)
+                for k, v in self.dist_set.items()
+            })
         reports = [self.rec_metrics.report(), self.gen_metrics.report(), self.optim_metrics.report()]
-        logger.info('\n' + nice_report(aggregate_unnamed_reports(reports)))
+        # each Metrics returns its cached dict while unchanged, so only re-render when one of them differs
+        if self._last_report is None or any(new is not old for new, old in zip(reports, self._last_report[0])):
+            self._last_report = (reports, nice_report(aggregate_unnamed_reports(reports)))
+        if _is_main_process():
+            logger.info('\n' + self._last_report[1])
 
     def reset_metrics(self):
         # rec
         self.rec_metrics.clear()
+        self._rec_slots = None
         # conv
         self.gen_metrics.clear()
         self.dist_cnt = 0
         self.dist_set.clear()
+        self._pack_grams = True
         # optim
         self.optim_metrics.clear()
@@ -1,4 +1,6 @@
 
+import os
+
 import torch
 from loguru import logger
 
@@ -16,6 +18,20 @@ def get_model(config, model_name, device, vocab, side_data=None):
         if config.opt["gpu"] == [-1]:
             return model
         else:
+            torch.backends.cudnn.benchmark = True
+            # let fp32 matmuls and convolutions run on tensor cores
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            if len(config["gpu"]) > 1:
+                if torch.distributed.is_available() and torch.distributed.is_initialized():
+                    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+                    # the gating layers and the session/knowledge hyper convs take no part in forward;
+                    # the buffers (KG edges, hypergraph CSR adjacency) never change, so skip their per-step broadcast
+                    return torch.nn.parallel.DistributedDataParallel(model.to(device), device_ids=[local_rank],
+                                                                     output_device=local_rank,
+                                                                     find_unused_parameters=True,
+                                                                     broadcast_buffers=False)
+                logger.warning('[Multiple GPUs without torch.distributed, launch with torchrun to use DDP]')
             return torch.nn.DataParallel(model, device_ids=config["gpu"])
 
     else:
@@ -21,5 +21,6 @@ class MHItemAttention(nn.Module):
         """
         context_entity = torch.unsqueeze(context_entity, 0)
         related_entity = torch.unsqueeze(related_entity, 0)
-        output, _ = self.MHA(context_entity, related_entity, related_entity)
+        # without attention weights, MultiheadAttention runs on F.scaled_dot_product_attention (flash / memory efficient kernels)
+        output, _ = self.MHA(context_entity, related_entity, related_entity, need_weights=False)
         return torch.squeeze(output, 0)
@@ -45,12 +45,13 @@ class TransformerDecoderLayerKG(nn.Module):
         self.norm3 = nn.LayerNorm(embedding_size)
 
     def forward(self, x, related_encoder_output, related_encoder_mask, context_encoder_output, context_encoder_mask,
-                session_embedding, session_mask):
-        decoder_mask = self._create_selfattn_mask(x)
+                session_embedding, session_mask, incr_state=None):
+        past_len = incr_state['prev_key'].size(1) if incr_state is not None and 'prev_key' in incr_state else 0
+        decoder_mask = self._create_selfattn_mask(x, past_len)
         # first self attn
         residual = x
         # don't peak into the future!
-        x = self.self_attention(query=x, mask=decoder_mask)
+        x = self.self_attention(query=x, mask=decoder_mask, incr_state=incr_state)
         x = self.dropout(x)  # --dropout
         x = x + residual
         x = _normalize(x, self.norm_self_attention)
@@ -95,12 +96,12 @@ class TransformerDecoderLayerKG(nn.Module):
 
         return x
 
-    def _create_selfattn_mask(self, x):
+    def _create_selfattn_mask(self, x, past_len=0):
         # figure out how many timestamps we need
         bsz = x.size(0)
         time = x.size(1)
-        # make sure that we don't look into the future
-        mask = torch.tril(x.new(time, time).fill_(1))
+        # make sure that we don't look into the future, the cached past_len steps are all visible
+        mask = torch.tril(x.new(time, past_len + time).fill_(1), diagonal=past_len)
         # broadcast across batch
         mask = mask.unsqueeze(0).expand(bsz, -1, -1)
         return mask
@@ -180,21 +181,32 @@ class TransformerDecoderKG(nn.Module):
             ))
 
     def forward(self, input, related_encoder_state, context_encoder_state, session_state, incr_state=None):
+        """
+        :param input: the tokens to decode. With incr_state, only the tokens that
+            follow the cached steps.
+        :param incr_state: the per-layer key/value cache returned by the previous call,
+            or None to start a new sequence.
+
+        :return: the output of the last layer and the updated incr_state.
+        """
         related_encoder_output, related_encoder_mask = related_encoder_state
         context_encoder_output, context_encoder_mask = context_encoder_state
         session_embedding, session_mask = session_state
+        if incr_state is None:
+            incr_state = [{} for _ in self.layers]
+        past_len = incr_state[0]['prev_key'].size(1) if 'prev_key' in incr_state[0] else 0
 
         seq_len = input.shape[1]
         positions = input.new_empty(seq_len).long()
-        positions = torch.arange(seq_len, out=positions).unsqueeze(0)  # (batch, seq_len)
+        positions = torch.arange(past_len, past_len + seq_len, out=positions).unsqueeze(0)  # (batch, seq_len)
         tensor = self.embeddings(input)
         if self.embeddings_scale:
             tensor = tensor * np.sqrt(self.dim)
         tensor = tensor + self.position_embeddings(positions).expand_as(tensor)
         tensor = self.dropout(tensor)  # --dropout
 
-        for layer in self.layers:
+        for layer, layer_state in zip(self.layers, incr_state):
             tensor = layer(tensor, related_encoder_output, related_encoder_mask, context_encoder_output,
-                           context_encoder_mask, session_embedding, session_mask)
+                           context_encoder_mask, session_embedding, session_mask, layer_state)
 
-        return tensor, None
+        return tensor, incr_state
@@ -1,9 +1,15 @@
 
 
+import functools
 import json
 import os.path
+import pickle as pkl
 import random
+import tempfile
+from itertools import chain
+from typing import Optional
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 from loguru import logger
@@ -20,18 +26,64 @@ from crslab.model.utils.modules.attention import SelfAttentionBatch
 from crslab.model.utils.modules.transformer import TransformerEncoder
 from crslab.model.crs.mhim.decoder import TransformerDecoderKG
 
+@torch.jit.script
+def sigmoid_gate(emb, weight, bias):
+    # scripted so that the sigmoid and the multiply fuse into one pointwise kernel
+    return emb * torch.sigmoid(F.linear(emb, weight, bias))
+
+
+@torch.jit.script
+def self_supervision_loss(user_embeddings, edge_embeddings, user_perm, local_col_perm, local_row_perm,
+                          global_col_perm, global_row_perm):
+    # -log(sigmoid(x)) is computed as softplus(-x), which does not overflow for large |x|
+    # Local MIM
+    pos = torch.sum(user_embeddings * edge_embeddings, dim=1)
+    neg1 = torch.sum(user_embeddings[user_perm] * edge_embeddings, dim=1)
+    neg2 = torch.sum(edge_embeddings[:, local_col_perm][local_row_perm] * user_embeddings, dim=1)
+    local_loss = torch.sum(F.softplus(neg1 - pos) + F.softplus(neg2 - neg1))
+    # Global MIM
+    graph = torch.mean(edge_embeddings, dim=0, keepdim=True)
+    pos = torch.sum(edge_embeddings * graph, dim=1)
+    neg1 = torch.sum(edge_embeddings[:, global_col_perm][global_row_perm] * graph, dim=1)
+    global_loss = torch.sum(F.softplus(neg1 - pos))
+    return global_loss + local_loss
+
+
+@torch.jit.script
+def decode_logits(latent, token_logits, user_logits, user_latent, copy_weight_1, copy_bias_1,
+                  copy_weight_2, copy_bias_2, copy_mask: Optional[torch.Tensor]):
+    # scripted so that the per-step projections of decode_greedy run without interpreter overhead
+    copy_latent = torch.cat((user_latent.expand(-1, latent.size(1), -1), latent), dim=-1)
+    # the hidden activation has no other consumer, so it is rectified in place
+    copy_logits = F.linear(torch.relu_(F.linear(copy_latent, copy_weight_1, copy_bias_1)), copy_weight_2, copy_bias_2)
+    if copy_mask is not None:
+        copy_logits = copy_logits * copy_mask
+    return token_logits + user_logits + copy_logits
+
+
+def user_decode_states(user_embedding, proj_weight_1, proj_bias_1, proj_weight_2, proj_bias_2,
+                       latent_weight, latent_bias):
+    user_logits = F.linear(F.relu(F.linear(user_embedding, proj_weight_1, proj_bias_1), inplace=True),
+                           proj_weight_2, proj_bias_2)
+    user_latent = F.linear(user_embedding, latent_weight, latent_bias)
+    return user_logits.unsqueeze(1), user_latent.unsqueeze(1)
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_user_decode_states():
+    # compiled once per process and called with the weights of whichever replica runs it
+    # lets inductor fuse user_proj_1, the relu and user_proj_2 instead of writing both activations out
+    return torch.compile(user_decode_states, dynamic=True)
+
+
 class GatingLayer(nn.Module):
     def __init__(self, dim):
         super(GatingLayer, self).__init__()
         self.dim = dim
         self.linear = nn.Linear(self.dim, self.dim)
-        self.activation = nn.Sigmoid()
 
     def forward(self, emb):
-        embedding = self.linear(emb)
-        embedding = self.activation(embedding)
-        embedding = torch.mul(emb, embedding)
-        return embedding
+        return sigmoid_gate(emb, self.linear.weight, self.linear.bias)
 
 
 class AttLayer(nn.Module):
@@ -42,14 +94,10 @@ class AttLayer(nn.Module):
         self.attention = nn.Parameter(torch.randn([1, self.dim]))
 
     def forward(self, *embs):
-        weights = []
-        emb_list = []
-        for embedding in embs:
-            weights.append(torch.sum(torch.mul(self.attention, torch.matmul(embedding, self.attention_mat)), dim=1))
-            emb_list.append(embedding)
-        score = torch.nn.Softmax(dim=0)(torch.stack(weights, dim=0))
-        embeddings = torch.stack(emb_list, dim=0)
-        mixed_embeddings = torch.mul(embeddings, score.unsqueeze(dim=2).repeat(1, 1, self.dim)).sum(dim=0)
+        embeddings = torch.stack(embs, dim=0)  # (n_embs, n_nodes, dim)
+        weights = torch.sum(torch.matmul(embeddings, self.attention_mat) * self.attention, dim=-1)
+        score = torch.softmax(weights, dim=0)
+        mixed_embeddings = torch.sum(embeddings * score.unsqueeze(-1), dim=0)
         return mixed_embeddings
 
 class MHIMModel(BaseModel):
@@ -79,6 +127,10 @@ class MHIMModel(BaseModel):
         n_positions: A integer indicating the number of position.
         longest_label: A integer indicating the longest length for response generation.
         user_proj_dim: A integer indicating dim to project for user embedding.
+        compile_modules: A boolean indicating if we compile the transformer and gating modules with torch.compile.
+        bf16: A boolean indicating if we run the model under bfloat16 autocast on CUDA.
+        finish_check_interval: A integer indicating how many greedy decoding steps run between end token checks.
+        cuda_graph: A boolean indicating if we replay the greedy decoding head from a CUDA graph at test time.
 
     """
 
@@ -107,9 +159,6 @@ class MHIMModel(BaseModel):
         self.n_entity = vocab['n_entity']
         self.entity_kg = side_data['entity_kg']
         self.n_relation = self.entity_kg['n_relation']
-        self.edge_idx, self.edge_type = edge_to_pyg_format(self.entity_kg['edge'], 'RGCN')
-        self.edge_idx = self.edge_idx.to(device)
-        self.edge_type = self.edge_type.to(device)
         self.num_bases = opt.get('num_bases', 8)
         self.kg_emb_dim = opt.get('kg_emb_dim', 300)
         self.user_emb_dim = self.kg_emb_dim
@@ -126,6 +175,13 @@ class MHIMModel(BaseModel):
         self.n_positions = opt.get('n_positions', 1024)
         self.longest_label = opt.get('longest_label', 30)
         self.user_proj_dim = opt.get('user_proj_dim', 512)
+        self.finish_check_interval = opt.get('finish_check_interval', 8)
+        self.cuda_graph = opt.get('cuda_graph', False) and torch.device(device).type == 'cuda'
+        if self.cuda_graph and self._data_parallel_fallback():
+            # DataParallel replicas would capture and replay graphs from concurrent threads
+            logger.warning('[cuda_graph is disabled under DataParallel, launch with torchrun to use it]')
+            self.cuda_graph = False
+        self._decode_graphs = {}
         # pooling
         self.pooling = opt.get('pooling', None)
         assert self.pooling == 'Attn' or self.pooling == 'Mean'
@@ -135,6 +191,12 @@ class MHIMModel(BaseModel):
         self.pretrain = opt.get('pretrain', False)
         self.pretrain_data = None
         self.pretrain_epoch = opt.get('pretrain_epoch', 9999)
+        self.compile_modules = opt.get('compile', False)
+        # the RGCN output is reused while the kg encoder is frozen or in eval mode
+        self._kg_frozen = False
+        self._kg_embedding_cache = {}
+        # mixed precision
+        self.bf16 = opt.get('bf16', True) and torch.device(device).type == 'cuda' and torch.cuda.is_bf16_supported()
 
         super(MHIMModel, self).__init__(opt, device)
 
@@ -150,6 +212,29 @@ class MHIMModel(BaseModel):
         self._build_recommendation_layer()
         self._build_conversation_layer()
         self._build_gating_layer()
+        if self.compile_modules:
+            self._compile_modules()
+
+    def _data_parallel_fallback(self):
+        """Whether get_model wraps this model in DataParallel, i.e. several GPUs without a torch.distributed group."""
+        return isinstance(self.gpu, list) and len(self.gpu) > 1 and \
+            not (torch.distributed.is_available() and torch.distributed.is_initialized())
+
+    def _compile_modules(self):
+        """Compile the transformer, gating and user projection modules in place, which keeps their state_dict keys."""
+        if not hasattr(torch, 'compile'):
+            logger.warning('[torch.compile needs PyTorch 2.0, modules are left uncompiled]')
+            self.compile_modules = False
+            return
+        if self._data_parallel_fallback():
+            # the compiled forwards are bound to these modules, DataParallel replicas would all run the cuda:0 weights
+            logger.warning('[compile is disabled under DataParallel, launch with torchrun to use it]')
+            self.compile_modules = False
+            return
+        for module in (self.related_encoder, self.context_encoder, self.decoder,
+                       self.attn_items, self.attn_entitys, self.attn_words):
+            module.forward = torch.compile(module.forward, dynamic=True)
+        logger.info('[Compile transformer and gating modules]')
 
     def _build_gating_layer(self):
         self.gate_items_H_j = GatingLayer(self.kg_emb_dim)
@@ -170,18 +255,32 @@ class MHIMModel(BaseModel):
         return
 
     def _build_copy_mask(self):
+        if self.dataset != 'HReDial':
+            # not for tg-redial, decode_logits skips the mask when the buffer is None
+            self.register_buffer('copy_mask_b', None, persistent=False)
+            return
         token_filename = os.path.join(DATASET_PATH, "hredial", "token2id.json")
-        token_file = open(token_filename, 'r', encoding="utf-8")
-        token2id = json.load(token_file)
-        id2token = {token2id[token]: token for token in token2id}
-        self.copy_mask = list()
-        for i in range(len(id2token)):
-            token = id2token[i]
-            if token[0] == '@':
-                self.copy_mask.append(True)
-            else:
-                self.copy_mask.append(False)
-        self.copy_mask = torch.as_tensor(self.copy_mask).to(self.device)
+        mask_filename = os.path.join(DATASET_PATH, "hredial", "copy_mask.pt")
+        if os.path.exists(mask_filename) and os.path.getmtime(mask_filename) >= os.path.getmtime(token_filename):
+            try:
+                self._register_copy_mask(torch.load(mask_filename))
+                return
+            except Exception as e:
+                logger.warning(f"[Rebuild unreadable copy mask cache {mask_filename}: {e!r}]")
+        with open(token_filename, 'r', encoding="utf-8") as token_file:
+            token2id = json.load(token_file)
+        id2token = [None] * len(token2id)
+        for token, idx in token2id.items():
+            id2token[idx] = token
+        copy_mask = np.fromiter((token[0] == '@' for token in id2token), dtype=np.bool_, count=len(id2token))
+        copy_mask = torch.from_numpy(copy_mask)
+        self._save_cache(mask_filename, lambda f: torch.save(copy_mask, f))
+        self._register_copy_mask(copy_mask)
+
+    def _register_copy_mask(self, copy_mask):
+        self.copy_mask = copy_mask.to(self.device)
+        # broadcastable over (batch_size, seq_len, vocab_size) copy logits
+        self.register_buffer('copy_mask_b', self.copy_mask.view(1, 1, -1), persistent=False)
 
     def _build_adjacent_matrix(self):
         graph = dict()
@@ -199,19 +298,81 @@ class MHIMModel(BaseModel):
                     adj[entity].update(graph[source])
                     buffer.update(graph[source])
                 last_hop = buffer
-        self.adj = adj
-        self.u2e = sparse.csr_matrix(sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "u2e.npz")))
-        self.u2i = sparse.csr_matrix(sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "u2i.npz")))
-        self.u2w = sparse.csr_matrix(sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "u2w.npz")))
-        self.e2e = sparse.csr_matrix(sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "e2e.npz")))
-        self.i2i = sparse.csr_matrix(sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "i2i.npz")))
-        self.w2w = sparse.csr_matrix(sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "w2w.npz")))
-        self.items_H_s, self.items_H_j, self.items_H_p            = self._build_motif_adj_matrix(self.i2i, self.u2i.T)
-        self.entitys_H_s, self.entitys_H_j, self.entitys_H_p      = self._build_motif_adj_matrix(self.e2e, self.u2e.T)
-        self.words_H_s, self.words_H_j, self.words_H_p            = self._build_motif_adj_matrix(self.w2w, self.u2w.T)
+        self._register_adjacency('adj', adj)
+        # tocsr() returns the loaded matrix itself when it was saved as CSR
+        self.u2e = sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "u2e.npz")).tocsr()
+        self.u2i = sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "u2i.npz")).tocsr()
+        self.u2w = sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "u2w.npz")).tocsr()
+        self.e2e = sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "e2e.npz")).tocsr()
+        self.i2i = sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "i2i.npz")).tocsr()
+        self.w2w = sparse.load_npz(os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", "w2w.npz")).tocsr()
+        for name, net_matrix, inter_matrix, sources in (('items', self.i2i, self.u2i.T, ('i2i', 'u2i')),
+                                                        ('entitys', self.e2e, self.u2e.T, ('e2e', 'u2e')),
+                                                        ('words', self.w2w, self.u2w.T, ('w2w', 'u2w'))):
+            motif_adj = self._load_motif_adj_matrix(name, net_matrix, inter_matrix, sources)
+            for motif, motif_adj_dict in zip(('H_s', 'H_j', 'H_p'), motif_adj):
+                self._register_adjacency(f'{name}_{motif}', motif_adj_dict)
         logger.info(f"[Adjacent Matrix built.]")
         return
 
+    def _register_adjacency(self, name, adj):
+        """Keep adj as CSR index buffers, which follow the model to its device."""
+        indptr, indices = self.adj2csr(adj)
+        self.register_buffer(f'{name}_indptr', torch.from_numpy(indptr), persistent=False)
+        self.register_buffer(f'{name}_indices', torch.from_numpy(indices), persistent=False)
+
+    def _adjacency(self, name):
+        """Return the (indptr, indices) CSR buffers of the adjacency registered as name."""
+        return getattr(self, f'{name}_indptr'), getattr(self, f'{name}_indices')
+
+    def _motif_cache_path(self, name):
+        return os.path.join(DATASET_PATH, self.dataset.lower(), "motif", f"{name}.pkl")
+
+    def _load_motif_adj_matrix(self, name, net_matrix, inter_matrix, sources):
+        """Load the motif adjacency of name from disk, building and caching it if missing or stale."""
+        cache_path = self._motif_cache_path(name)
+        source_paths = [os.path.join(DATASET_PATH, f"{self.dataset.lower()}/edge-mat", f"{source}.npz") for source in sources]
+        if os.path.exists(cache_path) and \
+                all(os.path.getmtime(cache_path) >= os.path.getmtime(path) for path in source_paths):
+            try:
+                with open(cache_path, 'rb') as f:
+                    motif_adj = pkl.load(f)
+                logger.info(f"[Load motif adjacency from {cache_path}]")
+                return motif_adj
+            except Exception as e:
+                logger.warning(f"[Rebuild unreadable motif adjacency cache {cache_path}: {e!r}]")
+        motif_adj = self._build_motif_adj_matrix(net_matrix, inter_matrix)
+        if self._save_cache(cache_path, lambda f: pkl.dump(motif_adj, f, protocol=pkl.HIGHEST_PROTOCOL)):
+            logger.info(f"[Save motif adjacency to {cache_path}]")
+        return motif_adj
+
+    @staticmethod
+    def _save_cache(cache_path, save):
+        """Write a cache file through save(file), returning False if it could not be written.
+
+        The data goes to a temporary file in the same directory first and is renamed into place, so a crash
+        or a concurrent writer (another torchrun rank) never leaves a truncated cache behind.
+
+        """
+        cache_dir = os.path.dirname(cache_path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        except OSError as e:
+            logger.warning(f"[Cannot write cache {cache_path}: {e}]")
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                save(f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"[Cannot write cache {cache_path}: {e}]")
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return True
+
     def _build_motif_adj_matrix(self, net_matrix:sparse.csr_matrix, inter_matrix:sparse.csr_matrix) -> tuple[sparse.csr_matrix, sparse.csr_matrix, sparse.csr_matrix]:
         S = net_matrix
         Y = inter_matrix
@@ -239,23 +400,32 @@ class MHIMModel(BaseModel):
         H_p = A10
         H_p = H_p.multiply(H_p > 1)
         H_p = H_p.multiply(1.0 / (H_p.sum(axis=1) + 1e-7).reshape(-1, 1))
-        H_s = self.mat2adj(sparse.csr_matrix(H_s))
-        H_j = self.mat2adj(sparse.csr_matrix(H_j))
-        H_p = self.mat2adj(sparse.csr_matrix(H_p))
+        H_s = self.mat2adj(H_s)
+        H_j = self.mat2adj(H_j)
+        H_p = self.mat2adj(H_p)
         return H_s, H_j, H_p
     
-    def mat2adj(self, mat:sparse.csr_matrix):
-        adj = dict()
-        mat = sparse.coo_matrix(mat)
-        for node1, node2, weight in zip(mat.row, mat.col, mat.data):
-            node1 = int(node1)
-            node2 = int(node2)
-            weight = float(weight)
-            if weight >= 0.5:
-                if node1 not in adj:
-                    adj[node1] = set()
-                adj[node1].add(node2)
-        return adj
+    def mat2adj(self, mat:sparse.spmatrix):
+        mat = mat.tocoo()
+        keep = mat.data >= 0.5
+        rows, cols = mat.row[keep], mat.col[keep]
+        order = np.argsort(rows, kind='stable')
+        rows, cols = rows[order], cols[order]
+        nodes, starts = np.unique(rows, return_index=True)
+        ends = np.append(starts[1:], len(rows))
+        cols = cols.tolist()
+        return {node: set(cols[start:end]) for node, start, end in zip(nodes.tolist(), starts.tolist(), ends.tolist())}
+
+    def adj2csr(self, adj):
+        """Convert a dict of node -> neighbor set into CSR (indptr, indices) arrays covering every node id."""
+        nodes = sorted(adj)
+        sizes = [len(adj[node]) for node in nodes]
+        indices = np.fromiter(chain.from_iterable(adj[node] for node in nodes), dtype=np.int64, count=sum(sizes))
+        n_nodes = max(self.n_entity, nodes[-1] + 1 if nodes else 0, int(indices.max()) + 1 if len(indices) else 0)
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        indptr[np.asarray(nodes, dtype=np.int64) + 1] = sizes
+        np.cumsum(indptr, out=indptr)
+        return indptr, indices
 
     def _build_embedding(self):
         if self.pretrain_embedding is not None:
@@ -273,6 +443,10 @@ class MHIMModel(BaseModel):
         logger.debug('[Build embedding]')
 
     def _build_kg_layer(self):
+        # buffers follow the module across devices, including the DataParallel replicas
+        edge_idx, edge_type = edge_to_pyg_format(self.entity_kg['edge'], 'RGCN')
+        self.register_buffer('edge_idx', edge_idx.to(self.device), persistent=False)
+        self.register_buffer('edge_type', edge_type.to(self.device), persistent=False)
         # graph encoder
         self.kg_encoder = RGCNConv(self.kg_emb_dim, self.kg_emb_dim, self.n_relation, num_bases=self.num_bases)
         if self.pretrain:
@@ -346,6 +520,10 @@ class MHIMModel(BaseModel):
             self.pad_token_idx,
             self.n_positions
         )
+        # output projection tied to the token embedding
+        self.lm_head = nn.Linear(self.token_emb_dim, self.vocab_size, bias=False)
+        self.lm_head.weight = self.token_embedding.weight
+        self._register_load_state_dict_pre_hook(self._load_state_dict_pre_hook)
         self.user_proj_1 = nn.Linear(self.user_emb_dim, self.user_proj_dim)
         self.user_proj_2 = nn.Linear(self.user_proj_dim, self.vocab_size)
         self.conv_loss = nn.CrossEntropyLoss(ignore_index=self.pad_token_idx)
@@ -354,6 +532,17 @@ class MHIMModel(BaseModel):
         self.copy_proj_2 = nn.Linear(self.token_emb_dim, self.vocab_size)
         logger.debug('[Build conversation layer]')
 
+    def _to_device(self, array):
+        """Copy an int64 array to the device without blocking, through pinned memory on CUDA."""
+        tensor = torch.from_numpy(array)
+        if torch.device(self.device).type == 'cuda':
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True)
+
+    def _edge_index_to_device(self, hypergraph_nodes, hypergraph_edges):
+        """Stack int64 node and edge arrays into a (2, n) edge index on the device."""
+        return self._to_device(np.stack([hypergraph_nodes, hypergraph_edges]))
+
     def _get_session_hypergraph(self, session_related_entities):
         hypergraph_nodes, hypergraph_edges, hyper_edge_counter = list(), list(), 0
         for related_entities in session_related_entities:
@@ -362,47 +551,35 @@ class MHIMModel(BaseModel):
             hypergraph_nodes += related_entities
             hypergraph_edges += [hyper_edge_counter] * len(related_entities)
             hyper_edge_counter += 1
-        hyper_edge_index = torch.tensor([hypergraph_nodes, hypergraph_edges], device=self.device)
+        hyper_edge_index = self._edge_index_to_device(
+            np.asarray(hypergraph_nodes, dtype=np.int64), np.asarray(hypergraph_edges, dtype=np.int64))
         return list(set(hypergraph_nodes)), hyper_edge_index
 
     def _get_knowledge_hypergraph(self, session_related_items, adj=None):
-        adj = self.adj if adj == None else adj
-        hypergraph_nodes, hypergraph_edges, hyper_edge_counter = list(), list(), 0
-        for item in session_related_items:
-            hypergraph_nodes.append(item)
-            hypergraph_edges.append(hyper_edge_counter)
-            neighbors = []
-            if item in adj:
-                neighbors = list(adj[item])
-            hypergraph_nodes += neighbors
-            hypergraph_edges += [hyper_edge_counter] * len(neighbors)
-            hyper_edge_counter += 1
-        hyper_edge_index = torch.LongTensor([hypergraph_nodes, hypergraph_edges]).to(self.device)
-        return list(set(hypergraph_nodes)), hyper_edge_index
+        adj = self._adjacency('adj') if adj is None else adj
+        session_related_items = self._to_device(np.asarray(session_related_items, dtype=np.int64))
+        hypergraph_nodes, hypergraph_edges = self._csr_hyperedges(*adj, session_related_items)
+        hyper_edge_index = torch.stack([hypergraph_nodes, hypergraph_edges])
+        return list(set(hypergraph_nodes.tolist())), hyper_edge_index
+
+    def _get_knowledge_embedding(self, hypergraph_items, raw_knowledge_embedding, adj=None, hyper_edge_index=None):
+        """Mean of each item's embedding and its neighbors', from one gather and one scatter.
 
-    def _get_knowledge_embedding(self, hypergraph_items, raw_knowledge_embedding, adj=None):
-        adj = self.adj if adj == None else adj
-        knowledge_embedding_list = []
-        for item in hypergraph_items:
-            neighbors = []
-            if item in adj:
-                neighbors = list(adj[item])
-            sub_graph = [item] + neighbors
-            sub_graph_embedding = raw_knowledge_embedding[sub_graph]
-            sub_graph_embedding = torch.mean(sub_graph_embedding, dim=0)
-            knowledge_embedding_list.append(sub_graph_embedding)
-        return torch.stack(knowledge_embedding_list, dim=0)
+        hyper_edge_index may be passed when it was already built for the same items and adj by
+        _get_knowledge_hypergraph, whose hyperedges are exactly these sub graphs.
+        """
+        if hyper_edge_index is None:
+            hyper_edge_index = self._get_knowledge_hypergraph(hypergraph_items, adj)[1]
+        sub_graph_nodes, sub_graph_ids = hyper_edge_index
+        sub_graph_sizes = torch.bincount(sub_graph_ids, minlength=len(hypergraph_items)).unsqueeze(1)
+        knowledge_embedding = raw_knowledge_embedding.new_zeros(len(hypergraph_items), raw_knowledge_embedding.size(1))
+        knowledge_embedding.index_add_(0, sub_graph_ids, raw_knowledge_embedding[sub_graph_nodes])
+        return knowledge_embedding / sub_graph_sizes
 
     @staticmethod
     def flatten(inputs):
-        outputs = set()
-        for li in inputs:
-            if type(li) == type([]):
-                for i in li:
-                    outputs.add(i)
-            else:
-                outputs.add(li)
-        return list(outputs)
+        # dict.fromkeys deduplicates in C and keeps the first-seen order
+        return list(dict.fromkeys(chain.from_iterable(li if isinstance(li, list) else (li,) for li in inputs)))
 
     def _attention_and_gating(self, items_embedding, entitys_embedding, words_embedding):
         related_embedding = []
@@ -433,23 +610,19 @@ class MHIMModel(BaseModel):
         return user_repr
 
     def encode_user(self, batch_related_entities, batch_related_items, batch_context_entities, kg_embedding):
-        user_repr_list = []
+        # cold-start users without any context entity keep the zero representation
+        user_embedding = torch.zeros(len(batch_related_items), self.user_emb_dim, device=self.device)
         ss_loss = 0.0
-        for entitys_list, items_list, words_list in zip(batch_related_entities, batch_related_items, batch_context_entities):
+        cold_users, cold_words = [], []
+        warm_users, batch_items, batch_entitys, batch_words = [], [], [], []
+        for user, (entitys_list, items_list, words_list) in enumerate(zip(batch_related_entities, batch_related_items, batch_context_entities)):
             flattened_session_related_items = self.flatten(items_list)
 
             # COLD START
             if len(flattened_session_related_items) == 0:
-                if len(words_list) == 0:
-                    user_repr = torch.zeros(self.user_emb_dim, device=self.device)
-                elif self.pooling == 'Attn':
-                    user_repr = kg_embedding[words_list]
-                    user_repr = self.kg_attn(user_repr)
-                else:
-                    assert self.pooling == 'Mean'
-                    user_repr = kg_embedding[words_list]
-                    user_repr = torch.mean(user_repr, dim=0)
-                user_repr_list.append(user_repr)
+                if len(words_list) > 0:
+                    cold_users.append(user)
+                    cold_words.append(words_list)
                 continue
 
             # hypergraph_items, session_hyper_edge_index = self._get_session_hypergraph(session_related_items)
@@ -460,26 +633,29 @@ class MHIMModel(BaseModel):
             # raw_knowledge_embedding = self.hyper_conv_knowledge(kg_embedding, knowledge_hyper_edge_index)
             # knowledge_embedding = self._get_knowledge_embedding(hypergraph_items, raw_knowledge_embedding)
 
-            entitys_list = self.flatten(entitys_list)
-            items_list = self.flatten(items_list)
-            words_list = self.flatten(words_list)
-
-            items_repr   = self.encode_gating(
-                items_list, self.items_H_j, self.items_H_p, self.items_H_s, 
-                self.gate_items_H_j, self.gate_items_H_p, self.gate_items_H_s, self.gate_items_H_o,
-                self.attn_items, self.hyper_conv_items, kg_embedding
-            )
-            entitys_repr = self.encode_gating(
-                entitys_list, self.entitys_H_j, self.entitys_H_p, self.entitys_H_s, 
-                self.gate_entitys_H_j, self.gate_entitys_H_p, self.gate_entitys_H_s, self.gate_entitys_H_o,
-                self.attn_entitys, self.hyper_conv_entitys, kg_embedding
-            )
-            words_repr   = self.encode_gating(
-                words_list, self.entitys_H_j, self.entitys_H_p, self.entitys_H_s, 
-                self.gate_words_H_j, self.gate_words_H_p, self.gate_words_H_s, self.gate_words_H_o,
-                self.attn_words, self.hyper_conv_words, kg_embedding
-            )
-            
+            warm_users.append(user)
+            batch_entitys.append(self.flatten(entitys_list))
+            batch_items.append(flattened_session_related_items)
+            batch_words.append(self.flatten(words_list))
+
+        if cold_users:
+            user_embedding[cold_users] = self._pool_cold_users(cold_words, kg_embedding).to(user_embedding.dtype)
+
+        # one hypergraph convolution for all the users of the batch
+        batch_items_repr = self.encode_gating_batch(
+            batch_items, self._adjacency('items_H_j'), self._adjacency('items_H_p'), self._adjacency('items_H_s'),
+            self.attn_items, self.hyper_conv_items, kg_embedding
+        )
+        batch_entitys_repr = self.encode_gating_batch(
+            batch_entitys, self._adjacency('entitys_H_j'), self._adjacency('entitys_H_p'), self._adjacency('entitys_H_s'),
+            self.attn_entitys, self.hyper_conv_entitys, kg_embedding
+        )
+        batch_words_repr = self.encode_gating_batch(
+            batch_words, self._adjacency('entitys_H_j'), self._adjacency('entitys_H_p'), self._adjacency('entitys_H_s'),
+            self.attn_words, self.hyper_conv_words, kg_embedding
+        )
+
+        for user, items_repr, entitys_repr, words_repr in zip(warm_users, batch_items_repr, batch_entitys_repr, batch_words_repr):
             user_repr = self._attention_and_gating(items_repr, entitys_repr, words_repr)
 
             if not items_repr == None:
@@ -489,89 +665,160 @@ class MHIMModel(BaseModel):
             if not words_repr == None:
                 ss_loss += self.hierarchical_self_supervision(user_repr, words_repr)
 
-            user_repr_list.append(user_repr)
-        user_embedding = torch.stack(user_repr_list, dim=0)
+            user_embedding[user] = user_repr
 
         return user_embedding, ss_loss
     
+    def _pool_cold_users(self, batch_words, kg_embedding):
+        """Pool the context entities of every cold-start user at once, as kg_attn or the mean would per user."""
+        sizes = [len(words) for words in batch_words]
+        words = np.fromiter(chain.from_iterable(batch_words), dtype=np.int64, count=sum(sizes))
+        segment_ids = self._to_device(np.repeat(np.arange(len(sizes), dtype=np.int64), sizes))
+        words_embedding = kg_embedding[self._to_device(words)]
+        if self.pooling == 'Attn':
+            return self.kg_attn.forward_segments(words_embedding, segment_ids, len(sizes))
+        assert self.pooling == 'Mean'
+        words_sum = words_embedding.new_zeros(len(sizes), words_embedding.size(1)).index_add_(0, segment_ids, words_embedding)
+        return words_sum / words_embedding.new_tensor(sizes).unsqueeze(1)
+
     def encode_gating(self, lists, H_j_adj, H_p_adj, H_s_adj, H_j_gate, H_p_gate, H_s_gate, H_o_gate, Attn, hyper_conv, kg_embedding):
-        if len(lists) == 0:
-            return None
-        H_j_embedding = hyper_conv(kg_embedding, self._get_knowledge_hypergraph(lists, H_j_adj)[1])
-        H_j_embedding = self._get_knowledge_embedding(lists, H_j_embedding, H_j_adj)
-        H_p_embedding = hyper_conv(kg_embedding, self._get_knowledge_hypergraph(lists, H_p_adj)[1])
-        H_p_embedding = self._get_knowledge_embedding(lists, H_p_embedding, H_p_adj)
-        H_s_embedding = hyper_conv(kg_embedding, self._get_knowledge_hypergraph(lists, H_s_adj)[1])
-        H_s_embedding = self._get_knowledge_embedding(lists, H_s_embedding, H_s_adj)
-        raw_embedding = kg_embedding[lists]
+        return self.encode_gating_batch([lists], H_j_adj, H_p_adj, H_s_adj, Attn, hyper_conv, kg_embedding)[0]
+
+    def encode_gating_batch(self, batch_lists, H_j_adj, H_p_adj, H_s_adj, Attn, hyper_conv, kg_embedding):
+        """Encode several node lists on the H_j, H_p and H_s hypergraphs with a single hypergraph convolution.
+
+        Every (graph, list) pair gets its own copy of the nodes its hyperedges touch, so node degrees, and
+        with them the convolution, are the same as if each list was encoded on each graph on its own.
+
+        Returns:
+            list: the (len(lists), kg_emb_dim) embedding of each list, or None for an empty list.
+        """
+        sizes = [len(lists) for lists in batch_lists]
+        n_lists = sum(sizes)
+        if n_lists == 0:
+            return [None] * len(batch_lists)
+        flat_lists = self._to_device(np.fromiter(chain.from_iterable(batch_lists), dtype=np.int64, count=n_lists))
+        list_owner = self._to_device(np.repeat(np.arange(len(batch_lists), dtype=np.int64), sizes))
+        graph_nodes, graph_edges = [], []
+        for graph, adj in enumerate((H_j_adj, H_p_adj, H_s_adj)):
+            hypergraph_nodes, hypergraph_edges = self._csr_hyperedges(*adj, flat_lists)
+            graph_nodes.append(hypergraph_nodes)
+            graph_edges.append(hypergraph_edges + graph * n_lists)
+        hypergraph_nodes, hypergraph_edges = torch.cat(graph_nodes), torch.cat(graph_edges)
+        # every CSR adjacency covers all node ids, so no node id reaches n_nodes
+        n_nodes = max(len(adj[0]) for adj in (H_j_adj, H_p_adj, H_s_adj)) - 1
+        node_copy = hypergraph_edges // n_lists * len(batch_lists) + list_owner[hypergraph_edges % n_lists]
+        owned_nodes, local_nodes = torch.unique(node_copy * n_nodes + hypergraph_nodes, return_inverse=True)
+        hyper_edge_index = torch.stack([local_nodes, hypergraph_edges])
+        node_embedding = kg_embedding[owned_nodes % n_nodes]
+        graph_embedding = hyper_conv(node_embedding, hyper_edge_index)
+        graph_embedding = self._get_knowledge_embedding(flat_lists.repeat(3), graph_embedding,
+                                                        hyper_edge_index=hyper_edge_index)
+        H_j_embedding, H_p_embedding, H_s_embedding = torch.split(graph_embedding, n_lists)
+        raw_embedding = kg_embedding[flat_lists]
         all_emb = Attn(H_j_embedding, H_p_embedding, H_s_embedding, raw_embedding)
+        return [emb if size > 0 else None for emb, size in zip(torch.split(all_emb, sizes), sizes)]
+
+    @staticmethod
+    def _csr_hyperedges(indptr, indices, lists):
+        """Build one hyperedge per node in lists, holding the node followed by its row of a CSR adjacency.
+
+        All tensors are int64 and on the same device, so the edges are built without leaving it.
+
+        Returns:
+            (hypergraph_nodes, hypergraph_edges)
+        """
+        starts = indptr[lists]
+        sizes = indptr[lists + 1] - starts + 1
+        hypergraph_edges = torch.repeat_interleave(torch.arange(len(lists), device=lists.device), sizes)
+        heads = torch.cumsum(sizes, dim=0) - sizes
+        # the k-th entry of an edge is its head node for k = 0 and sits at indptr[node] + k - 1 in indices otherwise
+        offsets = torch.arange(len(hypergraph_edges), device=lists.device) - heads[hypergraph_edges]
+        if indices.numel() == 0:
+            return lists[hypergraph_edges], hypergraph_edges
+        neighbor_pos = (starts[hypergraph_edges] + offsets - 1).clamp_(0, indices.numel() - 1)
+        hypergraph_nodes = torch.where(offsets == 0, lists[hypergraph_edges], indices[neighbor_pos])
+        return hypergraph_nodes, hypergraph_edges
 
-        return all_emb
-    
     def get_gate_edge(self, lists, mat:sparse.csr_matrix):
-        hypergraph_nodes, hypergraph_edges, hyper_edge_counter = [], [], 0
-        for node in lists:
-            related_node = [node] + list(sparse.coo_matrix(mat.getrow(node)).col)
-            hypergraph_nodes += related_node
-            hypergraph_edges += [hyper_edge_counter] * len(related_node)
-            hyper_edge_counter += 1
-        hyper_edge_index = torch.LongTensor([hypergraph_nodes, hypergraph_edges]).to(self.device)
+        hypergraph_nodes, hypergraph_edges = self._csr_hyperedges(
+            torch.from_numpy(mat.indptr.astype(np.int64)), torch.from_numpy(mat.indices.astype(np.int64)),
+            torch.as_tensor(lists, dtype=torch.long))
+        hyper_edge_index = torch.stack([hypergraph_nodes, hypergraph_edges]).to(self.device)
         return hyper_edge_index
 
     def recommend(self, batch, mode):
         related_entities, related_items = batch['related_entities'], batch['related_items']
         context_entities, item = batch['context_entities'], batch['item']
-        kg_embedding = self.kg_encoder(self.kg_embedding.weight, self.edge_idx, self.edge_type)  # (n_entity, emb_dim)
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.bf16):
+            kg_embedding = self._encode_kg()  # (n_entity, emb_dim)
         extended_items = batch['extended_items']
-        for i in range(len(related_items)):
-            truncate = min(int(max(2, int(len(related_items[i]) / 4))), len(extended_items[i]))
-            if self.extension_strategy == 'Adaptive':
-                related_items[i] = related_items[i] + extended_items[i][:truncate]
-            else:
-                assert self.extension_strategy == 'Random'
-                extended_items_sample = random.sample(extended_items[i], truncate)
-                related_items[i] = related_items[i] + extended_items_sample
-
-        user_embedding, ss_loss = self.encode_user(
-            related_entities,
-            related_items,
-            context_entities,
-            kg_embedding
-        )  # (batch_size, emb_dim)
-        scores = F.linear(user_embedding, kg_embedding, self.rec_bias.bias)  # (batch_size, n_entity)
+        related_lens = np.fromiter(map(len, related_items), dtype=np.int64, count=len(related_items))
+        extended_lens = np.fromiter(map(len, extended_items), dtype=np.int64, count=len(extended_items))
+        truncates = np.minimum(np.maximum(2, related_lens // 4), extended_lens).tolist()
+        if self.extension_strategy == 'Adaptive':
+            related_items[:] = [items + extended[:truncate]
+                                for items, extended, truncate in zip(related_items, extended_items, truncates)]
+        else:
+            assert self.extension_strategy == 'Random'
+            # random.sample keeps the extension reproducible under the seeded python RNG
+            related_items[:] = [items + random.sample(extended, truncate)
+                                for items, extended, truncate in zip(related_items, extended_items, truncates)]
+
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.bf16):
+            user_embedding, ss_loss = self.encode_user(
+                related_entities,
+                related_items,
+                context_entities,
+                kg_embedding
+            )  # (batch_size, emb_dim)
+            scores = F.linear(user_embedding, kg_embedding, self.rec_bias.bias)  # (batch_size, n_entity)
+        # the losses stay in fp32
+        scores = scores.float()
         rec_loss = self.rec_loss(scores, item)
         loss =  0.2 * ss_loss + 0.8 * rec_loss
         return loss, scores
     
     def hierarchical_self_supervision(self, user_embeddings, edge_embeddings):
-        user_embeddings = user_embeddings
-        edge_embeddings = edge_embeddings
-        def row_shuffle(embedding):
-            shuffled_embeddings = embedding[torch.randperm(embedding.size(0))]
-            return shuffled_embeddings
-        def row_column_shuffle(embedding):
-            shuffled_embeddings = embedding[:, torch.randperm(embedding.size(1))]
-            shuffled_embeddings = shuffled_embeddings[torch.randperm(embedding.size(0))]
-            return shuffled_embeddings
-        def score(x1, x2):
-            return torch.sum(torch.mul(x1, x2), dim=1)
-        
-        # Local MIM
-        pos = score(user_embeddings, edge_embeddings)
-        neg1 = score(row_shuffle(user_embeddings), edge_embeddings)
-        neg2 = score(row_column_shuffle(edge_embeddings), user_embeddings)
-        local_loss = torch.sum(-torch.log(torch.sigmoid(pos - neg1)) - torch.log(torch.sigmoid(neg1 - neg2)))
-        # Global MIM
-        graph = torch.mean(edge_embeddings, dim=0, keepdim=True)
-        pos = score(edge_embeddings, graph)
-        neg1 = score(row_column_shuffle(edge_embeddings), graph)
-        global_loss = torch.sum(-torch.log(torch.sigmoid(pos - neg1)))
-        return global_loss + local_loss
+        device = edge_embeddings.device
+        # negatives come from the same random permutations, drawn in the same order, as the unfused version
+        user_perm = torch.randperm(user_embeddings.size(0)).to(device)
+        local_col_perm = torch.randperm(edge_embeddings.size(1)).to(device)
+        local_row_perm = torch.randperm(edge_embeddings.size(0)).to(device)
+        global_col_perm = torch.randperm(edge_embeddings.size(1)).to(device)
+        global_row_perm = torch.randperm(edge_embeddings.size(0)).to(device)
+        return self_supervision_loss(user_embeddings, edge_embeddings, user_perm,
+                                     local_col_perm, local_row_perm, global_col_perm, global_row_perm)
 
     def _starts(self, batch_size):
         """Return bsz start tokens."""
         return self.START.detach().expand(batch_size, 1)
 
+    def _encode_kg(self):
+        """Run the RGCN over the whole KG, reusing the last result while it cannot change."""
+        if self.training and not self._kg_frozen:
+            return self.kg_encoder(self.kg_embedding.weight, self.edge_idx, self.edge_type)
+        # one entry per autocast state and device, as DataParallel replicas share this cache
+        cache_key = (self.kg_embedding.weight.device, torch.is_autocast_enabled())
+        if cache_key not in self._kg_embedding_cache:
+            with torch.no_grad():
+                self._kg_embedding_cache[cache_key] = self.kg_encoder(
+                    self.kg_embedding.weight, self.edge_idx, self.edge_type)
+        return self._kg_embedding_cache[cache_key]
+
+    def train(self, mode=True):
+        self._kg_embedding_cache.clear()
+        self._decode_graphs.clear()
+        return super(MHIMModel, self).train(mode)
+
+    def _load_state_dict_pre_hook(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                  error_msgs):
+        # runs for a direct load_state_dict and for one through a DataParallel/DDP wrapper, where keys carry prefix
+        self._kg_embedding_cache.clear()
+        if prefix + 'lm_head.weight' not in state_dict and prefix + 'token_embedding.weight' in state_dict:
+            # checkpoints saved before lm_head existed only hold the tied weight under token_embedding
+            state_dict[prefix + 'lm_head.weight'] = state_dict[prefix + 'token_embedding.weight']
+
     def freeze_parameters(self):
         freeze_models = [
             self.kg_embedding,
@@ -590,22 +837,19 @@ class MHIMModel(BaseModel):
         for model in freeze_models:
             for p in model.parameters():
                 p.requires_grad = False
+        self._kg_frozen = True
+        self._kg_embedding_cache.clear()
 
-    def encode_session(self, batch_related_items, batch_context_entities, kg_embedding):
+    def encode_session(self, batch_related_entities, batch_related_items, batch_context_entities, kg_embedding):
         """
             Return: session_repr (batch_size, batch_seq_len, token_emb_dim), mask (batch_size, batch_seq_len)
         """
-        session_repr_list = []
-        for session_related_items, context_entities in zip(batch_related_items, batch_context_entities):
-            flattened_session_related_items = self.flatten(session_related_items)
+        warm_sessions, batch_items, batch_entitys, batch_words = [], [], [], []
+        for session, (entitys_list, items_list, words_list) in enumerate(zip(batch_related_entities, batch_related_items, batch_context_entities)):
+            flattened_session_related_items = self.flatten(items_list)
 
-            # COLD START
+            # COLD START: the context entities make up the whole session
             if len(flattened_session_related_items) == 0:
-                if len(context_entities) == 0:
-                    session_repr_list.append(None)
-                else:
-                    session_repr = kg_embedding[context_entities]
-                    session_repr_list.append(session_repr)
                 continue
 
             # TOTAL
@@ -617,50 +861,105 @@ class MHIMModel(BaseModel):
             # raw_knowledge_embedding = self.hyper_conv_knowledge(kg_embedding, knowledge_hyper_edge_index)
             # knowledge_embedding = self._get_knowledge_embedding(hypergraph_items, raw_knowledge_embedding)
 
-            entitys_list = self.flatten(entitys_list)
-            items_list = self.flatten(items_list)
-            words_list = self.flatten(words_list)
-
-            items_repr   = self.encode_gating(
-                items_list, self.items_H_j, self.items_H_p, self.items_H_s, 
-                self.gate_items_H_j, self.gate_items_H_p, self.gate_items_H_s, self.gate_items_H_o,
-                self.attn_items, self.hyper_conv_items, kg_embedding
-            )
-            entitys_repr = self.encode_gating(
-                entitys_list, self.entitys_H_j, self.entitys_H_p, self.entitys_H_s, 
-                self.gate_entitys_H_j, self.gate_entitys_H_p, self.gate_entitys_H_s, self.gate_entitys_H_o,
-                self.attn_entitys, self.hyper_conv_entitys, kg_embedding
-            )
-            words_repr   = self.encode_gating(
-                words_list, self.entitys_H_j, self.entitys_H_p, self.entitys_H_s, 
-                self.gate_words_H_j, self.gate_words_H_p, self.gate_words_H_s, self.gate_words_H_o,
-                self.attn_words, self.hyper_conv_words, kg_embedding
-            )
-
-            if len(context_entities) == 0:
-                session_repr = torch.cat((items_repr, entitys_repr, words_repr), dim=0)
-                session_repr_list.append(session_repr)
-            else:
-                context_embedding = kg_embedding[context_entities]
-                session_repr = torch.cat((items_repr, entitys_repr, words_repr, context_embedding), dim=0)
-                session_repr_list.append(session_repr)
-
-        batch_seq_len = max([session_repr.size(0) for session_repr in session_repr_list if session_repr is not None])
-        mask_list = []
-        for i in range(len(session_repr_list)):
-            if session_repr_list[i] is None:
-                mask_list.append([False] * batch_seq_len)
-                zero_repr = torch.zeros((batch_seq_len, self.kg_emb_dim), device=self.device, dtype=torch.float)
-                session_repr_list[i] = zero_repr
-            else:
-                mask_list.append([False] * (batch_seq_len - session_repr_list[i].size(0)) + [True] * session_repr_list[i].size(0))
-                zero_repr = torch.zeros((batch_seq_len - session_repr_list[i].size(0), self.kg_emb_dim),
-                                        device=self.device, dtype=torch.float)
-                session_repr_list[i] = torch.cat((zero_repr, session_repr_list[i]), dim=0)
+            warm_sessions.append(session)
+            batch_entitys.append(self.flatten(entitys_list))
+            batch_items.append(flattened_session_related_items)
+            batch_words.append(self.flatten(words_list))
 
-        session_repr_embedding = torch.stack(session_repr_list, dim=0)
-        session_repr_embedding = self.entity_to_token(session_repr_embedding)
-        return session_repr_embedding, torch.tensor(mask_list, device=self.device, dtype=torch.bool)
+        # one hypergraph convolution for all the sessions of the batch
+        batch_items_repr = self.encode_gating_batch(
+            batch_items, self._adjacency('items_H_j'), self._adjacency('items_H_p'), self._adjacency('items_H_s'),
+            self.attn_items, self.hyper_conv_items, kg_embedding
+        )
+        batch_entitys_repr = self.encode_gating_batch(
+            batch_entitys, self._adjacency('entitys_H_j'), self._adjacency('entitys_H_p'), self._adjacency('entitys_H_s'),
+            self.attn_entitys, self.hyper_conv_entitys, kg_embedding
+        )
+        batch_words_repr = self.encode_gating_batch(
+            batch_words, self._adjacency('entitys_H_j'), self._adjacency('entitys_H_p'), self._adjacency('entitys_H_s'),
+            self.attn_words, self.hyper_conv_words, kg_embedding
+        )
+
+        # gather every session's rows in batch order and copy them into the packed tensor at once
+        warm_reprs = dict(zip(warm_sessions, zip(batch_items_repr, batch_entitys_repr, batch_words_repr)))
+        session_rows, session_lens = [], []
+        for session, context_entities in enumerate(batch_context_entities):
+            rows = [emb for emb in warm_reprs.get(session, ()) if emb is not None]
+            if len(context_entities) > 0:
+                rows.append(kg_embedding[context_entities])
+            session_rows.extend(rows)
+            session_lens.append(sum(emb.size(0) for emb in rows))
+
+        # project the packed rows only, then left-pad them for the decoder's cross attention
+        batch_seq_len = max(session_lens)
+        session_repr = torch.cat(session_rows, dim=0)
+        session_repr = self.entity_to_token(session_repr)  # (total_len, token_emb_dim)
+        session_lens = self._to_device(np.array(session_lens, dtype=np.int64))
+        positions = torch.arange(batch_seq_len, device=self.device)
+        mask = positions.unsqueeze(0) >= (batch_seq_len - session_lens).unsqueeze(1)  # (batch_size, batch_seq_len)
+        # padded positions hold entity_to_token(0), as they did when the zero padding was projected
+        session_repr_embedding = self.entity_to_token.bias.to(session_repr.dtype).expand(
+            len(session_lens), batch_seq_len, -1).clone()
+        session_repr_embedding[mask] = session_repr
+        return session_repr_embedding, mask
+
+    def _user_decode_states(self, user_embedding):
+        """
+            Return: user_logits (batch_size, 1, vocab_size), user_latent (batch_size, 1, token_emb_dim)
+        """
+        states = compiled_user_decode_states() if self.compile_modules else user_decode_states
+        return states(user_embedding, self.user_proj_1.weight, self.user_proj_1.bias,
+                      self.user_proj_2.weight, self.user_proj_2.bias,
+                      self.entity_to_token.weight, self.entity_to_token.bias)
+
+    def _decode_logits(self, latent, user_logits, user_latent):
+        """
+            Return: sum_logits (batch_size, seq_len, vocab_size)
+        """
+        return decode_logits(latent, self.lm_head(latent), user_logits, user_latent,
+                             self.copy_proj_1.weight, self.copy_proj_1.bias,
+                             self.copy_proj_2.weight, self.copy_proj_2.bias, self.copy_mask_b)
+
+    def _greedy_decode_head(self, user_logits, user_latent):
+        """Return a function mapping the decoder output of one greedy step to its sum_logits.
+
+        With cuda_graph set, the head is captured once per batch shape and replayed on every step,
+        which turns its dozen kernel launches into one. The decoder itself is not captured,
+        as its key/value cache grows by one token per step.
+
+        """
+        if not self.cuda_graph or torch.is_grad_enabled():
+            return lambda scores: self._decode_logits(scores, user_logits, user_latent)
+
+        def decode_head(scores):
+            # replicas share this dict, a graph replays its own device's weights only
+            key = (scores.device, scores.shape, scores.dtype, user_logits.dtype, user_latent.dtype)
+            if key not in self._decode_graphs:
+                self._decode_graphs[key] = self._capture_decode_head(scores, user_logits, user_latent)
+            graph, static_inputs, static_logits = self._decode_graphs[key]
+            for static_input, value in zip(static_inputs, (scores, user_logits, user_latent)):
+                static_input.copy_(value)
+            graph.replay()
+            return static_logits
+
+        return decode_head
+
+    def _capture_decode_head(self, scores, user_logits, user_latent):
+        static_inputs = (scores.clone(), user_logits.clone(), user_latent.clone())
+        # autocast must not cache casted weights across the capture
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=torch.is_autocast_enabled(),
+                            cache_enabled=False):
+            # warm up on a side stream, as graph capture requires
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._decode_logits(*static_inputs)
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_logits = self._decode_logits(*static_inputs)
+        return graph, static_inputs, static_logits
 
     def decode_forced(self, related_encoder_state, context_encoder_state, session_state, user_embedding, resp):
         bsz = resp.size(0)
@@ -668,46 +967,42 @@ class MHIMModel(BaseModel):
         inputs = resp.narrow(1, 0, seqlen - 1)
         inputs = torch.cat([self._starts(bsz), inputs], 1)
         latent, _ = self.decoder(inputs, related_encoder_state, context_encoder_state, session_state)
-        token_logits = F.linear(latent, self.token_embedding.weight)
-        user_logits = self.user_proj_2(torch.relu(self.user_proj_1(user_embedding))).unsqueeze(1)
-
-        user_latent = self.entity_to_token(user_embedding)
-        user_latent = user_latent.unsqueeze(1).expand(-1, seqlen, -1)
-        copy_latent = torch.cat((user_latent, latent), dim=-1)
-        copy_logits = self.copy_proj_2(torch.relu(self.copy_proj_1(copy_latent)))
-        if self.dataset == 'HReDial':
-            copy_logits = copy_logits * self.copy_mask.unsqueeze(0).unsqueeze(0)  # not for tg-redial
-        sum_logits = token_logits + user_logits + copy_logits
+        user_logits, user_latent = self._user_decode_states(user_embedding)
+        sum_logits = self._decode_logits(latent, user_logits, user_latent)
         _, preds = sum_logits.max(dim=-1)
         return sum_logits, preds
 
     def decode_greedy(self, related_encoder_state, context_encoder_state, session_state, user_embedding):
         bsz = context_encoder_state[0].shape[0]
-        xs = self._starts(bsz)
+        # written in place step by step
+        xs = self.START.new_full((bsz, self.longest_label + 1), self.pad_token_idx)
+        xs[:, 0] = self.start_token_idx
         incr_state = None
-        logits = []
+        logits = None
+        # the user terms do not depend on the generated tokens
+        user_logits, user_latent = self._user_decode_states(user_embedding)
+        decode_head = self._greedy_decode_head(user_logits, user_latent)
+        finished = torch.zeros(bsz, dtype=torch.bool, device=xs.device)
+        n_steps = 0
         for i in range(self.longest_label):
-            scores, incr_state = self.decoder(xs, related_encoder_state, context_encoder_state, session_state, incr_state)  # incr_state is always None
+            # only the newest token goes in, the earlier ones are in the decoder's key/value cache
+            scores, incr_state = self.decoder(xs[:, i:i + 1], related_encoder_state, context_encoder_state, session_state, incr_state)
             scores = scores[:, -1:, :]
-            token_logits = F.linear(scores, self.token_embedding.weight)
-            user_logits = self.user_proj_2(torch.relu(self.user_proj_1(user_embedding))).unsqueeze(1)
-
-            user_latent = self.entity_to_token(user_embedding)
-            user_latent = user_latent.unsqueeze(1).expand(-1, 1, -1)
-            copy_latent = torch.cat((user_latent, scores), dim=-1)
-            copy_logits = self.copy_proj_2(torch.relu(self.copy_proj_1(copy_latent)))
-            if self.dataset == 'HReDial':
-                copy_logits = copy_logits * self.copy_mask.unsqueeze(0).unsqueeze(0)  # not for tg-redial
-            sum_logits = token_logits + user_logits + copy_logits
+            sum_logits = decode_head(scores)
             probs, preds = sum_logits.max(dim=-1)
-            logits.append(scores)
-            xs = torch.cat([xs, preds], dim=1)
-            # check if everyone has generated an end token
-            all_finished = ((xs == self.end_token_idx).sum(dim=1) > 0).sum().item() == bsz
-            if all_finished:
+            if logits is None:
+                logits = scores.new_empty((bsz, self.longest_label, scores.size(-1)))
+            logits[:, i:i + 1] = scores
+            xs[:, i + 1:i + 2] = preds
+            n_steps = i + 1
+            finished |= preds.squeeze(1) == self.end_token_idx
+            # check if everyone has generated an end token, only every few steps as the check syncs with the host
+            if n_steps % self.finish_check_interval == 0 and finished.all():
                 break
-        logits = torch.cat(logits, 1)
-        return logits, xs
+        # drop the steps run after everyone had generated an end token, with a single host sync
+        ended = ((xs[:, 1:n_steps + 1] == self.end_token_idx).cumsum(dim=1) > 0).all(dim=0)  # (n_steps,)
+        n_steps = int(torch.where(ended.any(), ended.int().argmax() + 1, xs.new_tensor(n_steps)))
+        return logits[:, :n_steps], xs[:, :n_steps + 1]
 
     def converse(self, batch, mode):
         related_tokens = batch['related_tokens']
@@ -716,34 +1011,34 @@ class MHIMModel(BaseModel):
         related_entities = batch['related_entities']
         context_entities = batch['context_entities']
         response = batch['response']
-        kg_embedding = self.kg_encoder(self.kg_embedding.weight, self.edge_idx, self.edge_type)  # (n_entity, emb_dim)
-        session_state = self.encode_session(
-            related_items,
-            context_entities,
-            kg_embedding
-        )  # (batch_size, batch_seq_len, token_emb_dim)
-        user_embedding, _ = self.encode_user(
-            related_entities,
-            related_items,
-            context_entities,
-            kg_embedding
-        )  # (batch_size, emb_dim)
-        related_encoder_state = self.related_encoder(related_tokens)
-        context_encoder_state = self.context_encoder(context_tokens)
-        if mode != 'test':
-            self.longest_label = max(self.longest_label, response.shape[1])
-            logits, preds = self.decode_forced(related_encoder_state, context_encoder_state, session_state, user_embedding, response)
-            logits = logits.view(-1, logits.shape[-1])
-            labels = response.view(-1)
-            return self.conv_loss(logits, labels), preds
-        else:
-            _, preds = self.decode_greedy(related_encoder_state, context_encoder_state, session_state, user_embedding)
-            return preds
+        with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.bf16):
+            kg_embedding = self._encode_kg()  # (n_entity, emb_dim)
+            session_state = self.encode_session(
+                related_entities,
+                related_items,
+                context_entities,
+                kg_embedding
+            )  # (batch_size, batch_seq_len, token_emb_dim)
+            user_embedding, _ = self.encode_user(
+                related_entities,
+                related_items,
+                context_entities,
+                kg_embedding
+            )  # (batch_size, emb_dim)
+            related_encoder_state = self.related_encoder(related_tokens)
+            context_encoder_state = self.context_encoder(context_tokens)
+            if mode != 'test':
+                self.longest_label = max(self.longest_label, response.shape[1])
+                logits, preds = self.decode_forced(related_encoder_state, context_encoder_state, session_state, user_embedding, response)
+            else:
+                _, preds = self.decode_greedy(related_encoder_state, context_encoder_state, session_state, user_embedding)
+                return preds
+        # the loss stays in fp32
+        logits = logits.float().view(-1, logits.shape[-1])
+        labels = response.view(-1)
+        return self.conv_loss(logits, labels), preds
 
     def forward(self, batch, mode, stage):
-        if len(self.gpu) >= 2:
-            self.edge_idx = self.edge_idx.cuda(torch.cuda.current_device())
-            self.edge_type = self.edge_type.cuda(torch.cuda.current_device())
         if stage == "conv":
             return self.converse(batch, mode)
         if stage == "rec":
@@ -22,6 +22,19 @@ class SelfAttentionBatch(nn.Module):
         attention = F.softmax(e, dim=0)  # (N)
         return torch.matmul(attention, h)  # (dim)
 
+    def forward_segments(self, h, segment_ids, n_segments):
+        """Pool every segment of h as forward does, all in one pass.
+
+        h: (N, dim), segment_ids: (N) index of the segment of each row
+        return: (n_segments, dim)
+        """
+        e = torch.matmul(torch.tanh(torch.matmul(h, self.a)), self.b).squeeze(dim=1)
+        # softmax inside each segment, shifted by the segment max for stability
+        e_max = e.new_full((n_segments,), float('-inf')).scatter_reduce(0, segment_ids, e.detach(), reduce='amax')
+        e = torch.exp(e - e_max[segment_ids])
+        attention = e / e.new_zeros(n_segments).index_add_(0, segment_ids, e)[segment_ids]
+        return h.new_zeros(n_segments, h.size(1)).index_add_(0, segment_ids, attention.unsqueeze(1) * h)
+
 
 class SelfAttentionSeq(nn.Module):
     def __init__(self, dim, da, alpha=0.2, dropout=0.5):
@@ -68,9 +68,10 @@ class MultiHeadAttention(nn.Module):
 
         nn.init.xavier_normal_(self.out_lin.weight)
 
-    def forward(self, query, key=None, value=None, mask=None):
+    def forward(self, query, key=None, value=None, mask=None, incr_state=None):
         # Input is [B, query_len, dim]
         # Mask is [B, key_len] (selfattn) or [B, key_len, key_len] (enc attn)
+        # incr_state, if given, is a dict caching the projected keys and values of earlier decoding steps
         batch_size, query_len, dim = query.size()
         assert dim == self.dim, \
             f'Dimensions do not match: {dim} query vs {self.dim} configured'
@@ -104,6 +105,12 @@ class MultiHeadAttention(nn.Module):
         q = prepare_head(self.q_lin(query))
         k = prepare_head(self.k_lin(key))
         v = prepare_head(self.v_lin(value))
+        if incr_state is not None:
+            if 'prev_key' in incr_state:
+                k = torch.cat([incr_state['prev_key'], k], dim=1)
+                v = torch.cat([incr_state['prev_value'], v], dim=1)
+                key_len = k.size(1)
+            incr_state['prev_key'], incr_state['prev_value'] = k, v
 
         dot_prod = q.div_(scale).bmm(k.transpose(1, 2))
         # [B * n_heads, query_len, key_len]
@@ -47,6 +47,11 @@ class BaseSystem(ABC):
             self.device = torch.device('cpu')
         elif len(opt["gpu"]) == 1:
             self.device = torch.device('cuda')
+        elif self._init_distributed():
+            # one process per GPU under torchrun, get_model wraps the model in DistributedDataParallel
+            local_rank = int(os.environ['LOCAL_RANK'])
+            torch.cuda.set_device(local_rank)
+            self.device = torch.device(f'cuda:{local_rank}')
         else:
             self.device = torch.device('cuda')
         # seed
@@ -55,8 +60,8 @@ class BaseSystem(ABC):
             random.seed(seed)
             np.random.seed(seed)
             torch.manual_seed(seed)
-            torch.cuda.manual_seed(seed)
-            torch.cuda.manual_seed_all(seed)
+            if self.device.type == 'cuda' and torch.cuda.is_available():
+                torch.cuda.manual_seed_all(seed)
             logger.info(f'[Set seed] {seed}')
         # data
         if debug:
@@ -88,7 +93,16 @@ class BaseSystem(ABC):
             self.restore_model()
 
         if not interact:
-            self.evaluator = get_evaluator('standard', opt['dataset'], opt['rankfile'])
+            self.evaluator = get_evaluator('standard', opt['dataset'], opt['rankfile'], opt.get('approx_dist', False))
+
+    @staticmethod
+    def _init_distributed():
+        """Join the process group set up by torchrun, return False when not launched by it."""
+        if not torch.distributed.is_available() or 'LOCAL_RANK' not in os.environ:
+            return False
+        if not torch.distributed.is_initialized():
+            torch.distributed.init_process_group('nccl')
+        return True
 
     def init_optim(self, opt, parameters):
         self.optim_opt = opt
@@ -122,7 +136,20 @@ class BaseSystem(ABC):
     def build_optimizer(self, parameters):
         optimizer_opt = self.optim_opt['optimizer']
         optimizer = optimizer_opt.pop('name')
-        self.optimizer = optim_class[optimizer](parameters, **optimizer_opt)
+        optimizer_class, optimizer_kwargs = optim_class[optimizer], dict(optimizer_opt)
+        if self.device.type == 'cuda':
+            if optimizer == 'AdamW' and optimizer_kwargs.get('correct_bias', True):
+                # torch's fused AdamW, with the eps and weight decay defaults of transformers' AdamW
+                optimizer_kwargs.pop('correct_bias', None)
+                optimizer_class = optim.AdamW
+                optimizer_kwargs = {'eps': 1e-6, 'weight_decay': 0.0, **optimizer_kwargs, 'fused': True}
+            else:
+                optimizer_kwargs['foreach'] = True
+        try:
+            self.optimizer = optimizer_class(parameters, **optimizer_kwargs)
+        except TypeError:
+            # older torch releases and optimizers outside torch.optim take neither fused nor foreach
+            self.optimizer = optim_class[optimizer](parameters, **optimizer_opt)
         logger.info(f"[Build optimizer: {optimizer}]")
 
     def build_lr_scheduler(self):
@@ -181,7 +208,7 @@ class BaseSystem(ABC):
         if self.update_freq > 1:
             self._number_grad_accum = (self._number_grad_accum + 1) % self.update_freq
             loss /= self.update_freq
-        loss.backward(loss.clone().detach())
+        loss.backward()
 
         self._update_params()
 
@@ -203,11 +230,10 @@ class BaseSystem(ABC):
             grad_norm = torch.nn.utils.clip_grad_norm_(
                 self.parameters, self.gradient_clip
             )
-            self.evaluator.optim_metrics.add('grad norm', AverageMetric(grad_norm))
-            self.evaluator.optim_metrics.add(
-                'grad clip ratio',
-                AverageMetric(float(grad_norm > self.gradient_clip)),
-            )
+            self.evaluator.optim_metrics.add_many({
+                'grad norm': AverageMetric(grad_norm),
+                'grad clip ratio': AverageMetric(float(grad_norm > self.gradient_clip)),
+            })
         else:
             grad_norm = compute_grad_norm(self.parameters)
             self.evaluator.optim_metrics.add('grad norm', AverageMetric(grad_norm))
@@ -254,6 +280,9 @@ class BaseSystem(ABC):
         if hasattr(self, 'policy_model'):
             state['policy_state_dict'] = self.policy_model.state_dict()
 
+        if torch.distributed.is_available() and torch.distributed.is_initialized() and torch.distributed.get_rank() != 0:
+            # the replicas hold the same weights, only one process writes them
+            return
         os.makedirs(SAVE_PATH, exist_ok=True)
         torch.save(state, self.model_file)
         logger.info(f'[Save model into {self.model_file}]')
@@ -262,17 +291,29 @@ class BaseSystem(ABC):
         r"""Store the model parameters."""
         if not os.path.exists(self.model_file):
             raise ValueError(f'Saved model [{self.model_file}] does not exist')
-        checkpoint = torch.load(self.model_file, map_location=self.device)
+        checkpoint = torch.load(self.model_file, map_location='cpu')
         if hasattr(self, 'model'):
-            self.model.load_state_dict(checkpoint['model_state_dict'])
+            self.model.load_state_dict(self._state_dict_to_device(checkpoint['model_state_dict']))
         if hasattr(self, 'rec_model'):
-            self.rec_model.load_state_dict(checkpoint['rec_state_dict'])
+            self.rec_model.load_state_dict(self._state_dict_to_device(checkpoint['rec_state_dict']))
         if hasattr(self, 'conv_model'):
-            self.conv_model.load_state_dict(checkpoint['conv_state_dict'])
+            self.conv_model.load_state_dict(self._state_dict_to_device(checkpoint['conv_state_dict']))
         if hasattr(self, 'policy_model'):
-            self.policy_model.load_state_dict(checkpoint['policy_state_dict'])
+            self.policy_model.load_state_dict(self._state_dict_to_device(checkpoint['policy_state_dict']))
         logger.info(f'[Restore model from {self.model_file}]')
 
+    def _state_dict_to_device(self, state_dict):
+        """Queue the copies of a CPU state dict to the device, through pinned memory on CUDA."""
+        if self.device.type != 'cuda':
+            return state_dict
+        moved = type(state_dict)(
+            (k, v.pin_memory().to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v)
+            for k, v in state_dict.items())
+        # load_state_dict reads the module versions from here
+        if hasattr(state_dict, '_metadata'):
+            moved._metadata = state_dict._metadata
+        return moved
+
     @abstractmethod
     def interact(self):
         pass
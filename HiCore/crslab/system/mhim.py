@@ -2,6 +2,7 @@
 
 import os
 import json
+import numpy as np
 import torch
 import pickle as pkl
 from loguru import logger
@@ -49,11 +50,8 @@ class MHIMSystem(BaseSystem):
         rec_predict = rec_predict.cpu()
         rec_predict = rec_predict[:, self.item_ids]
         _, rec_ranks = torch.topk(rec_predict, 100, dim=-1)
-        rec_ranks = rec_ranks.tolist()
-        item_label = item_label.tolist()
-        for rec_rank, label in zip(rec_ranks, item_label):
-            label = self.item_ids.index(label)
-            self.evaluator.rec_evaluate(rec_rank, label)
+        item_label = [self.item_ids.index(label) for label in item_label.tolist()]
+        self.evaluator.rec_evaluate_batch(rec_ranks.numpy(), np.asarray(item_label))
 
     def conv_evaluate(self, prediction, response, batch_user_id=None, batch_conv_id=None):
         prediction = prediction.tolist()